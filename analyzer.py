@@ -173,7 +173,8 @@ def tail_and_analyze(filepath: str):
     counters = _get_counters(source)
     log.info(f"[analyzer] watching {filepath}")
 
-    with open(filepath, "r") as f:
+    # Raw container output is captured byte-for-byte, so it may not be valid UTF-8
+    with open(filepath, "r", errors="replace") as f:
         f.seek(0, 2)  # seek to end
         while not shutdown_event.is_set():
             line = f.readline()
@@ -11,23 +11,42 @@ Spring log format:
   <docker_ts> <app_ts> <LEVEL> <pid> --- [<thread>] <logger> : <message>
 """
 
+import io
 import os
 import re
 import time
 import signal
 import logging
+import functools
 import threading
 from pathlib import Path
 
+import watchfiles
+
+# Only used for the Spring block candidate scan (see CANDIDATE_PATTERNS)
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
 LOG_DIR = Path(os.environ.get("LOG_DIR", "/app/logs"))
 IMPORTANT_DIR = LOG_DIR / "important"
-POLL_INTERVAL = int(os.environ.get("POLL_INTERVAL", "5"))
+READ_BLOCK_SIZE = 64 * 1024
+# Upper bound on how long watchfiles batches a burst of change events
+WATCH_DEBOUNCE_MS = 200
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
 )
 log = logging.getLogger(__name__)
+# watchfiles logs every batch of changes at INFO, i.e. once per appended line
+logging.getLogger("watchfiles").setLevel(logging.WARNING)
 
 # shutdown_event is injected by main.py when used as a module;
 # falls back to a local event when run standalone
@@ -48,46 +67,63 @@ if __name__ == "__main__":
 # Match lines that contain security-relevant paths or non-2xx status codes
 # ---------------------------------------------------------------------------
 
-# Paths that are always important regardless of status
-FLASK_IMPORTANT_PATHS = re.compile(
-    r'"(?:POST|PUT|DELETE|PATCH) (?:'
-    r'/users/reset_password/\d+'       # password reset
-    r'|/users/delete/\d+'             # user deletion
-    r'|/delete_user/[^"]*'            # kasm user deletion
-    r'|/update_user/[^"]*'            # user update
-    r'|/api/user'                     # user creation
-    r'|/login'                        # login attempts
-    r')'
+# Both rules live in one alternation so each line is only scanned once.
+# Every branch starts at a '"', which lets the engine skip ahead quickly on
+# lines that carry no request line at all.
+FLASK_COMBINED = re.compile(
+    rb'" [45]\d\d '                   # any 4xx/5xx response
+    rb'|"(?:POST|PUT|DELETE|PATCH) (?:'  # paths that are always important
+    rb'/users/reset_password/\d+'      # password reset
+    rb'|/users/delete/\d+'            # user deletion
+    rb'|/delete_user/'                # kasm user deletion
+    rb'|/update_user/'                # user update
+    rb'|/api/user'                    # user creation
+    rb'|/login'                       # login attempts
+    rb')'
 )
 
-# Any response that is 4xx or 5xx is worth logging
-FLASK_ERROR_STATUS = re.compile(r'" [45]\d\d ')
 
-
-def is_flask_important(line: str) -> bool:
-    return bool(FLASK_IMPORTANT_PATHS.search(line) or FLASK_ERROR_STATUS.search(line))
+def is_flask_important(line: bytes) -> bool:
+    return FLASK_COMBINED.search(line) is not None
 
 
 # ---------------------------------------------------------------------------
 # Spring filter rules
 # ---------------------------------------------------------------------------
 
+# Written in lowercase and matched against line.lower(): one bytes.lower()
+# pass is cheaper than re.IGNORECASE folding every character it compares
 SPRING_IMPORTANT_PATTERNS = re.compile(
-    r'(?:'
-    r'ERROR'                          # any ERROR level log
-    r'|password'                      # password-related operations
-    r'|/api/person.*(?:POST|PUT|DELETE)'  # user CRUD
-    r'|delete'                        # deletion operations
-    r'|migration'                     # schema migrations
-    r'|Exception'                     # exceptions
-    r'|WARN.*(?:auth|login|token|jwt|forbidden|unauthorized)'  # auth warnings
-    r')',
-    re.IGNORECASE
+    rb'(?:'
+    rb'error'                         # any ERROR level log
+    rb'|password'                     # password-related operations
+    rb'|delete'                       # deletion operations
+    rb'|migration'                    # schema migrations
+    rb'|exception'                    # exceptions
+    rb')'
+)
+
+# Rules that need one literal followed later on the same line by another.
+# As regex branches these need ".*", which backtracks over the rest of the
+# line for every occurrence of the first literal, so they are checked with
+# find() calls instead.
+SPRING_SEQUENCE_RULES = (
+    (b"/api/person", (b"post", b"put", b"delete")),  # user CRUD
+    (b"warn", (b"auth", b"login", b"token", b"jwt", b"forbidden", b"unauthorized")),  # auth warnings
 )
 
 
-def is_spring_important(line: str) -> bool:
-    return bool(SPRING_IMPORTANT_PATTERNS.search(line))
+def is_spring_important(line: bytes) -> bool:
+    lowered = line.lower()
+    if SPRING_IMPORTANT_PATTERNS.search(lowered) is not None:
+        return True
+    for first, followers in SPRING_SEQUENCE_RULES:
+        start = lowered.find(first)
+        if start != -1:
+            start += len(first)
+            if any(lowered.find(word, start) != -1 for word in followers):
+                return True
+    return False
 
 
 # ---------------------------------------------------------------------------
@@ -100,6 +136,7 @@ FILTERS = {
 }
 
 
+@functools.lru_cache(maxsize=1024)
 def detect_source(filename: str) -> str:
     name = filename.lower()
     if "flask" in name:
@@ -109,65 +146,255 @@ def detect_source(filename: str) -> str:
     return "unknown"
 
 
-def filter_source_matches(line: str) -> bool:
+FALLBACK_IMPORTANT_PATTERNS = re.compile(rb'\b(?:ERROR|WARN|Exception)\b')
+
+
+def filter_source_matches(line: bytes) -> bool:
     """Fallback: keep ERROR/WARN lines from any unknown source."""
-    return bool(re.search(r'\b(?:ERROR|WARN|Exception)\b', line))
+    return bool(FALLBACK_IMPORTANT_PATTERNS.search(line))
 
 
 # ---------------------------------------------------------------------------
-# File tail + filter loop
+# Block scanning
+# One native finditer() per read block finds the leading literal of every
+# rule; only the lines it turns up go through the per-line filters.
+# ---------------------------------------------------------------------------
+
+# (pattern, match against block.lower()) per source. Every rule of a source
+# starts with one of these literals, so a line with no hit cannot match.
+# The Spring alternation shares no prefix, which re scans position by
+# position; RE2 runs it as a DFA and is about 2x faster on typical blocks.
+# Everywhere else re's lower per-call overhead wins.
+CANDIDATE_PATTERNS = {
+    "flask": (re.compile(rb'" [45]|"(?:POST|PUT|DELETE|PATCH) '), False),
+    "spring": ((re2 or re).compile(rb'error|exception|warn|password|delete|migration|/api/person'), True),
+    "unknown": (FALLBACK_IMPORTANT_PATTERNS, False),
+}
+
+
+def _lines_at(block: bytes, match_ends: list[int]) -> list[bytes]:
+    """Return the lines of block (which must end in a newline) containing the given match ends."""
+    # None of the patterns can match across a newline, so each match end
+    # falls inside exactly one line
+    lines = []
+    line_end = -1
+    for end in match_ends:
+        if end <= line_end:
+            continue  # another match on a line we already have
+        line_start = block.rfind(b"\n", 0, end) + 1
+        line_end = block.index(b"\n", end)
+        lines.append(block[line_start:line_end + 1])
+    return lines
+
+
+def scan_block_regex(block: bytes, candidates, fold: bool, is_important) -> list[bytes]:
+    """Return every line of block (which must end in a newline) that is_important accepts."""
+    # bytes.lower() keeps every offset, so ends found in the folded copy
+    # index straight into the original block
+    haystack = block.lower() if fold else block
+    match_ends = [m.end() for m in candidates.finditer(haystack)]
+    return [line for line in _lines_at(block, match_ends) if is_important(line)]
+
+
+# ---------------------------------------------------------------------------
+# Hyperscan block scanning
+# When hyperscan is installed, each source's rules are compiled once into a
+# block-mode database and a whole read block is scanned in one native call,
+# which also makes the per-line filters above unnecessary.
 # ---------------------------------------------------------------------------
 
-def tail_and_filter(raw_log: Path):
-    source = detect_source(raw_log.name)
-    is_important = FILTERS.get(source, filter_source_matches)
+def _compile_hyperscan(expressions: list[bytes], flags: int = 0):
+    db = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+    db.compile(expressions=expressions, flags=flags)
+    return db
+
+
+def _sequence_expression(first: bytes, followers: tuple[bytes, ...]) -> bytes:
+    # Hyperscan runs ".*" as an automaton, so it has no backtracking cost
+    return re.escape(first) + rb".*(?:" + b"|".join(map(re.escape, followers)) + rb")"
+
 
-    out_path = IMPORTANT_DIR / raw_log.name
-    out_path.parent.mkdir(parents=True, exist_ok=True)
+HYPERSCAN_DATABASES = {}
+if hyperscan is not None:
+    HYPERSCAN_DATABASES = {
+        "flask": _compile_hyperscan([FLASK_COMBINED.pattern]),
+        "spring": _compile_hyperscan(
+            [SPRING_IMPORTANT_PATTERNS.pattern]
+            + [_sequence_expression(first, followers) for first, followers in SPRING_SEQUENCE_RULES],
+            hyperscan.HS_FLAG_CASELESS,
+        ),
+        "unknown": _compile_hyperscan([FALLBACK_IMPORTANT_PATTERNS.pattern]),
+    }
 
-    log.info(f"Filtering {raw_log.name} ({source}) -> {out_path}")
 
-    # Wait for the raw log to exist
-    while not raw_log.exists() and not shutdown_event.is_set():
-        shutdown_event.wait(POLL_INTERVAL)
+def _collect_match_end(expr_id, start, end, flags, match_ends):
+    match_ends.append(end)
 
-    with open(raw_log, "r") as infile, open(out_path, "a") as outfile:
-        # Seek to end so we only process new lines going forward
-        infile.seek(0, 2)
 
-        while not shutdown_event.is_set():
-            line = infile.readline()
-            if not line:
-                shutdown_event.wait(0.2)
+def scan_block_hyperscan(db, scratch, block: bytes) -> list[bytes]:
+    """Return every line of block (which must end in a newline) that has a match."""
+    match_ends: list[int] = []
+    db.scan(block, match_event_handler=_collect_match_end, context=match_ends, scratch=scratch)
+
+    # Several expressions can report matches, so sort to walk lines in order
+    match_ends.sort()
+    return _lines_at(block, match_ends)
+
+
+# ---------------------------------------------------------------------------
+# Per-source block scanners
+# The rule set is fixed at import, so each source gets one scanner with its
+# engine, patterns and filter already bound. A block costs one call, with no
+# per-block dispatch on which engine or rules to use.
+# ---------------------------------------------------------------------------
+
+def _make_scanner(source: str):
+    db = HYPERSCAN_DATABASES.get(source)
+    if db is not None:
+        # Scratch space is per-scan state; scanners only run on the filter thread
+        return functools.partial(scan_block_hyperscan, db, hyperscan.Scratch(db))
+    candidates, fold = CANDIDATE_PATTERNS[source]
+    return functools.partial(
+        scan_block_regex,
+        candidates=candidates,
+        fold=fold,
+        is_important=FILTERS.get(source, filter_source_matches),
+    )
+
+
+# source -> scanner(block) returning the block's important lines
+SCANNERS = {source: _make_scanner(source) for source in CANDIDATE_PATTERNS}
+
+
+# ---------------------------------------------------------------------------
+# File tail + filter loop
+# ---------------------------------------------------------------------------
+
+class LogTail:
+    """Incremental reader for one raw log that appends its important lines to IMPORTANT_DIR."""
+
+    def __init__(self, raw_log: Path, from_start: bool):
+        self.name = raw_log.name
+        self.source = detect_source(raw_log.name)
+        self.scan = SCANNERS[self.source]
+
+        out_path = IMPORTANT_DIR / raw_log.name
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+
+        log.info(f"Filtering {raw_log.name} ({self.source}) -> {out_path}")
+
+        # Unbuffered binary reads: drain() does its own block buffering, so
+        # each block costs one read() syscall no matter how many lines it holds
+        self.infile = io.open(raw_log, "rb", buffering=0)
+        self.fd = self.infile.fileno()
+        if not from_start:
+            # Seek to end so we only process new lines going forward
+            os.lseek(self.fd, 0, os.SEEK_END)
+        self.out_fd = os.open(out_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.partial = b""
+
+    def drain(self):
+        """Filter everything appended since the last call."""
+        # Matches from every block read here go out in as few write()s as possible
+        out = bytearray()
+        while block := os.read(self.fd, READ_BLOCK_SIZE):
+            # Hold back the trailing partial line until its newline arrives
+            data = self.partial + block
+            cut = data.rfind(b"\n") + 1
+            complete, self.partial = data[:cut], data[cut:]
+            if not complete:
                 continue
-            if is_important(line):
-                outfile.write(line)
-                outfile.flush()
+
+            out += b"".join(self.scan(complete))
+            if len(out) >= READ_BLOCK_SIZE:
+                self._write(out)
+                out.clear()
+        if out:
+            self._write(out)
+
+    def _write(self, data: bytearray):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.out_fd, view):]
+
+    def close(self):
+        """Release both fds; best-effort, so one failing step doesn't leak the rest."""
+        for step in (self.infile.close, lambda: os.fsync(self.out_fd), lambda: os.close(self.out_fd)):
+            try:
+                step()
+            except OSError as e:
+                log.warning(f"Error closing {self.name}: {e}")
+
+
+def _is_raw_log(change: watchfiles.Change, path: str) -> bool:
+    return path.endswith(".log")
+
+
+def _open_tail(raw_log: Path, from_start: bool) -> LogTail | None:
+    try:
+        return LogTail(raw_log, from_start=from_start)
+    except OSError as e:
+        log.error(f"Cannot tail {raw_log.name}: {e}")
+        return None
 
 
 def watch_for_new_logs():
-    """Watch LOG_DIR for new *.log files and spin up filter threads for them."""
-    known: set[str] = set()
-    threads: list[threading.Thread] = []
-
-    while not shutdown_event.is_set():
-        current = {p.name for p in LOG_DIR.glob("*.log")}
-        new = current - known
-        for name in new:
-            raw_log = LOG_DIR / name
-            t = threading.Thread(
-                target=tail_and_filter,
-                args=(raw_log,),
-                name=f"filter-{name}",
-                daemon=True,
-            )
-            t.start()
-            threads.append(t)
-            known.add(name)
-        shutdown_event.wait(POLL_INTERVAL)
-
-    for t in threads:
-        t.join(timeout=5)
+    """
+    Filter every *.log in LOG_DIR from a single thread.
+
+    One inotify watch on LOG_DIR reports which logs changed, and only those
+    are drained, so there is no per-file thread or per-file watch.
+    """
+    tails: dict[str, LogTail] = {}
+
+    # Logs that already exist are only filtered from now on; logs created
+    # later are filtered from their first line
+    for raw_log in LOG_DIR.glob("*.log"):
+        if tail := _open_tail(raw_log, from_start=False):
+            tails[raw_log.name] = tail
+
+    try:
+        # important/ lives under LOG_DIR, so stay non-recursive to skip our own writes
+        for changes in watchfiles.watch(
+            LOG_DIR,
+            watch_filter=_is_raw_log,
+            recursive=False,
+            debounce=WATCH_DEBOUNCE_MS,
+            stop_event=shutdown_event,
+        ):
+            # Handle deletions first, so a log removed and recreated within one
+            # batch ends up with a fresh tail rather than none
+            for change, path in sorted(changes, key=lambda c: c[0] != watchfiles.Change.deleted):
+                raw_log = Path(path)
+                if change == watchfiles.Change.deleted:
+                    if tail := tails.pop(raw_log.name, None):
+                        tail.close()
+                    continue
+
+                tail = tails.get(raw_log.name)
+                if tail is not None and change == watchfiles.Change.added:
+                    # Same name, new file (e.g. removed and recreated): reopen it
+                    tails.pop(raw_log.name).close()
+                    tail = None
+                if tail is None:
+                    # Only a newly created log is filtered from its first line.
+                    # A log we lost track of (failed open or dropped after an
+                    # error) resumes at its end, so old lines aren't re-emitted.
+                    tail = _open_tail(raw_log, from_start=change == watchfiles.Change.added)
+                    if tail is None:
+                        continue
+                    tails[raw_log.name] = tail
+
+                # One thread serves every log, so a failure on one file must
+                # not stop filtering for the others
+                try:
+                    tail.drain()
+                except Exception:
+                    log.exception(f"Filtering {raw_log.name} failed, dropping it")
+                    tails.pop(raw_log.name).close()
+    finally:
+        for tail in tails.values():
+            tail.close()
 
 
 if __name__ == "__main__":
@@ -50,13 +50,15 @@ def stream_container_logs(container_name: str):
     while not shutdown_event.is_set():
         try:
             container = client.containers.get(container_name)
-            with open(log_path, "a") as f:
+            # Binary append: each chunk from the Docker API goes straight to the
+            # file with no decode/encode round trip. BufferedWriter.write()
+            # handles short writes; flush() makes the chunk visible to the filter.
+            with open(log_path, "ab") as f:
                 # Stream logs since the last captured line; tail=0 means only new lines
-                for line in container.logs(stream=True, follow=True, timestamps=True):
+                for chunk in container.logs(stream=True, follow=True, timestamps=True):
                     if shutdown_event.is_set():
                         break
-                    decoded = line.decode("utf-8", errors="replace").rstrip("\n")
-                    f.write(decoded + "\n")
+                    f.write(chunk)
                     f.flush()
         except docker.errors.NotFound:
             log.warning(f"Container '{container_name}' not found, retrying in {POLL_INTERVAL}s...")
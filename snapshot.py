@@ -3,16 +3,23 @@ snapshot.py — Automated database snapshot system
 
 Handles two database types:
   1. Aurora/RDS (Flask production) — uses boto3 to create AWS snapshots
-  2. SQLite (Spring production) — copies the .db file to a timestamped backup
+  2. SQLite (Spring production) — backs up the .db file to a timestamped copy
 
 Can be run via cron, manually, or imported as a module (for future API use).
 """
 
 import os
 import sys
+import math
+import time
+import fcntl
 import shutil
+import sqlite3
 import logging
-from datetime import datetime, timedelta, timezone
+import threading
+import importlib.util
+from contextlib import closing
+from datetime import datetime, timezone
 from pathlib import Path
 
 logging.basicConfig(
@@ -36,15 +43,28 @@ RETENTION_MONTHLY = int(os.environ.get("RETENTION_MONTHLY", "3"))
 # Aurora/RDS snapshots
 # ---------------------------------------------------------------------------
 
+# Building a client loads its service model from disk, so reuse one per
+# service across runs. Creation is locked because boto3's default session
+# isn't thread-safe and the API server can trigger snapshots concurrently.
+_aws_clients: dict[str, object] = {}
+_aws_clients_lock = threading.Lock()
+
+
+def _aws_client(service: str):
+    with _aws_clients_lock:
+        if service not in _aws_clients:
+            import boto3
+            _aws_clients[service] = boto3.client(service, region_name=AWS_REGION)
+        return _aws_clients[service]
+
+
 def snapshot_aurora(trigger: str = "scheduled") -> bool:
     """Create an RDS snapshot with metadata tags."""
     if not RDS_INSTANCE_ID:
         log.warning("RDS_INSTANCE_ID not set, skipping Aurora snapshot")
         return False
 
-    try:
-        import boto3
-    except ImportError:
+    if importlib.util.find_spec("boto3") is None:
         log.error("boto3 not installed, cannot create Aurora snapshot")
         return False
 
@@ -52,7 +72,7 @@ def snapshot_aurora(trigger: str = "scheduled") -> bool:
     snapshot_id = f"{RDS_INSTANCE_ID}-{now.strftime('%Y%m%d-%H%M%S')}"
 
     try:
-        rds = boto3.client("rds", region_name=AWS_REGION)
+        rds = _aws_client("rds")
         log.info(f"Creating RDS snapshot: {snapshot_id}")
 
         rds.create_db_snapshot(
@@ -77,32 +97,40 @@ def cleanup_aurora():
     if not RDS_INSTANCE_ID:
         return
 
-    try:
-        import boto3
-    except ImportError:
+    if importlib.util.find_spec("boto3") is None:
         return
 
     try:
-        rds = boto3.client("rds", region_name=AWS_REGION)
+        rds = _aws_client("rds")
         response = rds.describe_db_snapshots(
             DBInstanceIdentifier=RDS_INSTANCE_ID,
             SnapshotType="manual",
         )
         snapshots = response.get("DBSnapshots", [])
 
-        # Only manage snapshots created by us
-        our_snapshots = []
+        # Only manage snapshots created by us. One paginated tagging API query
+        # finds all of them, instead of a tag lookup per snapshot.
+        paginator = _aws_client("resourcegroupstaggingapi").get_paginator("get_resources")
+        our_arns = {
+            resource["ResourceARN"]
+            for page in paginator.paginate(
+                TagFilters=[{"Key": "created_by", "Values": ["db-automator"]}],
+                ResourceTypeFilters=["rds:snapshot"],
+            )
+            for resource in page.get("ResourceTagMappingList", [])
+        }
+
+        our_snapshots = []  # (create time as epoch seconds, snapshot id)
         for snap in snapshots:
-            tags_resp = rds.list_tags_for_resource(ResourceName=snap["DBSnapshotArn"])
-            tags = {t["Key"]: t["Value"] for t in tags_resp.get("TagList", [])}
-            if tags.get("created_by") == "db-automator" and "SnapshotCreateTime" in snap:
-                our_snapshots.append({
-                    "id": snap["DBSnapshotIdentifier"],
-                    "time": snap["SnapshotCreateTime"],
-                })
-
-        our_snapshots.sort(key=lambda s: s["time"], reverse=True)
-        _apply_retention(our_snapshots, delete_fn=lambda s: _delete_aurora_snapshot(rds, s["id"]))
+            if snap["DBSnapshotArn"] in our_arns and "SnapshotCreateTime" in snap:
+                our_snapshots.append((snap["SnapshotCreateTime"].timestamp(), snap["DBSnapshotIdentifier"]))
+
+        our_snapshots.sort(key=lambda s: s[0], reverse=True)
+        _apply_retention(
+            ids=[snapshot_id for _, snapshot_id in our_snapshots],
+            times=[created for created, _ in our_snapshots],
+            delete_fn=lambda snapshot_id: _delete_aurora_snapshot(rds, snapshot_id),
+        )
 
     except Exception as e:
         log.error(f"Aurora cleanup failed: {e}")
@@ -118,7 +146,7 @@ def _delete_aurora_snapshot(rds, snapshot_id: str):
 # ---------------------------------------------------------------------------
 
 def snapshot_sqlite(trigger: str = "scheduled") -> bool:
-    """Copy the Spring SQLite database to a timestamped backup."""
+    """Back up the Spring SQLite database to a timestamped file."""
     if not SPRING_SQLITE_PATH.exists():
         log.warning(f"SQLite file not found at {SPRING_SQLITE_PATH}, skipping")
         return False
@@ -131,14 +159,31 @@ def snapshot_sqlite(trigger: str = "scheduled") -> bool:
     dest = dest_dir / filename
 
     try:
-        log.info(f"Copying SQLite database: {SPRING_SQLITE_PATH} -> {dest}")
-        shutil.copy2(SPRING_SQLITE_PATH, dest)
-
-        # Also copy WAL and SHM files if they exist (for consistency)
-        for suffix in ["-wal", "-shm"]:
-            wal = SPRING_SQLITE_PATH.parent / (SPRING_SQLITE_PATH.name + suffix)
-            if wal.exists():
-                shutil.copy2(wal, dest_dir / (filename + suffix))
+        log.info(f"Backing up SQLite database: {SPRING_SQLITE_PATH} -> {dest}")
+        src_uri = SPRING_SQLITE_PATH.resolve().as_uri() + "?mode=ro"
+        # Our fd to the database must outlive SQLite's lock: closing any fd on
+        # the file drops every POSIX lock this process holds on it
+        with open(SPRING_SQLITE_PATH, "rb") as fsrc:
+            if _is_wal_database(fsrc) and not _has_wal_files(SPRING_SQLITE_PATH):
+                # WAL database with no writer attached: the last connection
+                # checkpointed everything into the main file and removed -wal
+                # and -shm. A read-only connection would need to recreate -shm,
+                # which fails on the read-only volume, so copy the file as is
+                _clone_file(fsrc, dest)
+            else:
+                with closing(sqlite3.connect(src_uri, uri=True)) as src:
+                    if src.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+                        # Committed pages may still live only in -wal, so let the online
+                        # backup API assemble a consistent copy under SQLite's locking
+                        with closing(sqlite3.connect(dest)) as dst:
+                            src.backup(dst)
+                    else:
+                        # Rollback journal: an open read transaction holds a SHARED lock,
+                        # which keeps writers out of the main file while it is cloned
+                        src.execute("BEGIN")
+                        src.execute("SELECT count(*) FROM sqlite_master").fetchone()
+                        _clone_file(fsrc, dest)
+                        src.rollback()
 
         size_mb = dest.stat().st_size / (1024 * 1024)
         log.info(f"SQLite snapshot saved: {dest} ({size_mb:.1f} MB)")
@@ -146,21 +191,66 @@ def snapshot_sqlite(trigger: str = "scheduled") -> bool:
 
     except Exception as e:
         log.error(f"Failed to create SQLite snapshot: {e}")
+        dest.unlink(missing_ok=True)
         return False
 
 
+def _is_wal_database(fsrc) -> bool:
+    """Check the file format version bytes of the SQLite header (2 = WAL)."""
+    fsrc.seek(18)
+    return fsrc.read(2) == b"\x02\x02"
+
+
+def _has_wal_files(db_path: Path) -> bool:
+    return any(db_path.with_name(db_path.name + suffix).exists() for suffix in ("-wal", "-shm"))
+
+
+FICLONE = 0x40049409  # from <linux/fs.h>
+
+
+def _clone_file(fsrc, dest: Path):
+    """
+    Copy an open file to dest as cheaply as the filesystem allows:
+    a reflink on copy-on-write filesystems (btrfs, XFS), an in-kernel
+    copy_file_range otherwise, and a plain copy as the last resort.
+    """
+    src_fd = fsrc.fileno()
+    with open(dest, "wb") as fdst:
+        dst_fd = fdst.fileno()
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return
+        except OSError:
+            pass  # no reflink support, or source and dest are on different filesystems
+
+        try:
+            remaining = os.fstat(src_fd).st_size
+            offset = 0
+            while remaining > 0:
+                copied = os.copy_file_range(src_fd, dst_fd, remaining, offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+                remaining -= copied
+            return
+        except OSError:
+            fdst.truncate(0)
+
+        fsrc.seek(0)
+        shutil.copyfileobj(fsrc, fdst)
+
+
 def cleanup_sqlite():
     """Delete old SQLite backups beyond retention policy."""
     backup_dir = BACKUP_DIR / "spring"
     if not backup_dir.exists():
         return
 
-    backups = sorted(backup_dir.glob("sqlite_*.db"), key=lambda p: p.stat().st_mtime, reverse=True)
-
-    snapshots = [{"id": p.name, "time": datetime.fromtimestamp(p.stat().st_mtime), "path": p} for p in backups]
+    backups = [(p.stat().st_mtime, p.name) for p in backup_dir.glob("sqlite_*.db")]
+    backups.sort(key=lambda b: b[0], reverse=True)
 
-    def delete_sqlite_backup(snap):
-        path = snap["path"]
+    def delete_sqlite_backup(name: str):
+        path = backup_dir / name
         log.info(f"Deleting old SQLite backup: {path.name}")
         path.unlink()
         # Clean up associated WAL/SHM files
@@ -169,59 +259,61 @@ def cleanup_sqlite():
             if companion.exists():
                 companion.unlink()
 
-    _apply_retention(snapshots, delete_fn=delete_sqlite_backup)
+    _apply_retention(
+        ids=[name for _, name in backups],
+        times=[mtime for mtime, _ in backups],
+        delete_fn=delete_sqlite_backup,
+    )
 
 
 # ---------------------------------------------------------------------------
 # Retention logic
 # ---------------------------------------------------------------------------
 
-def _apply_retention(snapshots: list[dict], delete_fn):
+WEEK_SECONDS = 7 * 86400
+MONTH_SECONDS = 30 * 86400
+
+
+def _apply_retention(ids: list[str], times: list[float], delete_fn):
     """
     Keep the most recent RETENTION_DAILY snapshots,
     plus one per week for RETENTION_WEEKLY weeks,
     plus one per month for RETENTION_MONTHLY months.
     Delete the rest.
+
+    ids and times (epoch seconds) are parallel lists, newest first.
+    delete_fn is called with the id of each snapshot to delete.
     """
-    if not snapshots:
+    if not ids:
         return
 
-    now = datetime.now(timezone.utc).replace(tzinfo=None)
-    keep = set()
-
+    now = time.time()
     # Keep the N most recent (daily)
-    for snap in snapshots[:RETENTION_DAILY]:
-        keep.add(snap["id"])
-
-    # Keep one per week for the last N weeks
-    for weeks_ago in range(RETENTION_WEEKLY):
-        week_start = now - timedelta(weeks=weeks_ago + 1)
-        week_end = now - timedelta(weeks=weeks_ago)
-        for snap in snapshots:
-            t = snap["time"]
-            # Handle timezone-aware datetimes
-            if hasattr(t, 'tzinfo') and t.tzinfo is not None:
-                t = t.replace(tzinfo=None)
-            if week_start <= t < week_end:
-                keep.add(snap["id"])
-                break
-
-    # Keep one per month for the last N months
-    for months_ago in range(RETENTION_MONTHLY):
-        month_start = now - timedelta(days=30 * (months_ago + 1))
-        month_end = now - timedelta(days=30 * months_ago)
-        for snap in snapshots:
-            t = snap["time"]
-            if hasattr(t, 'tzinfo') and t.tzinfo is not None:
-                t = t.replace(tzinfo=None)
-            if month_start <= t < month_end:
-                keep.add(snap["id"])
-                break
+    keep = set(ids[:RETENTION_DAILY])
+    weeks_kept = set()
+    months_kept = set()
+
+    # Single pass, newest first: the first snapshot seen in a window is the
+    # one kept for it. Window n covers now - (n + 1) * period <= t < now - n * period.
+    for snapshot_id, t in zip(ids, times):
+        age = now - t
+
+        # Keep one per week for the last N weeks
+        weeks_ago = math.ceil(age / WEEK_SECONDS) - 1
+        if 0 <= weeks_ago < RETENTION_WEEKLY and weeks_ago not in weeks_kept:
+            weeks_kept.add(weeks_ago)
+            keep.add(snapshot_id)
+
+        # Keep one per month for the last N months
+        months_ago = math.ceil(age / MONTH_SECONDS) - 1
+        if 0 <= months_ago < RETENTION_MONTHLY and months_ago not in months_kept:
+            months_kept.add(months_ago)
+            keep.add(snapshot_id)
 
     # Delete everything not in the keep set
-    for snap in snapshots:
-        if snap["id"] not in keep:
-            delete_fn(snap)
+    for snapshot_id in ids:
+        if snapshot_id not in keep:
+            delete_fn(snapshot_id)
 
 
 # ---------------------------------------------------------------------------